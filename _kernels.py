@@ -0,0 +1,184 @@
+"""
+The compute kernels: PackBits encoding and decoding, and Atkinson dithering.
+Compiled with numba when it is installed, otherwise run as plain Python.
+build_kernels.py compiles them ahead of time into the macpaint_kernels extension module,
+which macpaint.py and formats.py prefer when present, to skip importing numba and JIT compiling.
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+    COMPILED = True
+except ImportError:
+    COMPILED = False
+    prange = range
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+
+@njit(cache=True, boundscheck=False)
+def pack_bits_row(src: np.ndarray, dst: np.ndarray) -> int:
+    """
+    :param src: uint8 bytes to compress
+    :param dst: uint8 output buffer, at least 2 * len(src) + 1 long
+    :return: number of bytes written to dst
+    """
+    n = src.size
+    i = 0
+    out = 0
+    while i < n:
+        if i + 2 < n and src[i] == src[i + 1] and src[i] == src[i + 2]:
+            # 3+ bytes the same, compress these
+            # (comparing 8 bytes at a time as uint64 words measured slower than this on 72-byte scanlines)
+            j = i
+            while j < n and src[j] == src[i] and j - i < 127:
+                j += 1
+            count = j - i
+            # the sign bit of the header is used to indicate whether the byte is repeated or a literal string
+            # when repeated, the count is the two's complement negative value of the header
+            # this must have been an efficient use of 68000 instructions or something
+            dst[out] = 256 - count + 1
+            dst[out + 1] = src[i]
+            out += 2
+        else:
+            # literal bytes, up to the start of the next 3+ run
+            j = i + 1
+            while j < n and j - i < 128:
+                if j + 2 < n and src[j] == src[j + 1] and src[j] == src[j + 2]:
+                    break
+                j += 1
+            count = j - i
+            # literal bytes header is 1+n: https://en.wikipedia.org/wiki/PackBits
+            dst[out] = count - 1
+            out += 1
+            for k in range(count):
+                dst[out + k] = src[i + k]
+            out += count
+        i = j
+    return out
+
+
+@njit(cache=True, boundscheck=False)
+def pack_bits_rows(rows: np.ndarray, dst: np.ndarray) -> int:
+    """
+    pack_bits_row on every row in turn, one after the other in dst
+    :param rows: 2-D uint8
+    :param dst: uint8 output buffer, at least len(rows) * (2 * len(rows[0]) + 1) long
+    :return: number of bytes written to dst
+    """
+    out = 0
+    for y in range(rows.shape[0]):
+        out += pack_bits_row(rows[y], dst[out:])
+    return out
+
+
+@njit(cache=True, boundscheck=False, parallel=True)
+def pack_bits_rows_parallel(rows: np.ndarray, dst: np.ndarray) -> int:
+    """
+    Same as pack_bits_rows, with the rows packed in parallel: each into its own worst-case sized slot first,
+    then the slots are packed together once their sizes, and so their offsets in dst, are known
+    """
+    height, width = rows.shape
+    stride = 2 * width + 1
+    slots = np.empty(height * stride, dtype=np.uint8)
+    sizes = np.empty(height, dtype=np.int64)
+    for y in prange(height):
+        sizes[y] = pack_bits_row(rows[y], slots[y * stride:(y + 1) * stride])
+    offsets = np.zeros(height + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(sizes)
+    for y in prange(height):
+        dst[offsets[y]:offsets[y + 1]] = slots[y * stride:y * stride + sizes[y]]
+    return offsets[height]
+
+
+@njit(cache=True, boundscheck=False)
+def unpack_bits(src: np.ndarray, dst: np.ndarray) -> int:
+    """
+    :param src: uint8 PackBits data
+    :param dst: uint8 output buffer; anything that decodes past its end is counted but not written
+    :return: total decoded length, which may be more than len(dst)
+    """
+    n = src.size
+    i = 0
+    out = 0
+    while i < n:
+        header = src[i]
+        if header == 128:
+            # ignored, next byte is another header
+            i += 1
+        elif header > 128:
+            # twos complement -1 to -127
+            # next byte repeated n times
+            if i + 1 >= n:
+                break
+            count = 256 - header + 1
+            for k in range(out, min(out + count, dst.size)):
+                dst[k] = src[i + 1]
+            out += count
+            i += 2
+        else:
+            # n bytes of literal uncompressed data
+            count = min(header + 1, n - i - 1)
+            for k in range(min(count, dst.size - out)):
+                dst[out + k] = src[i + 1 + k]
+            out += count
+            i += 1 + count
+    return out
+
+
+# tile size for the parallel wavefront, in rows x skewed columns
+TILE_ROWS = 90
+TILE_COLS = 126
+
+
+@njit(cache=True, boundscheck=False)
+def _diffuse(img: np.ndarray, out: np.ndarray, y: int, x: int, height: int, width: int):
+    """
+    https://en.wikipedia.org/wiki/Atkinson_dithering
+    Only 6/8 of the error is passed on, 1/8 to each of these neighbors:
+          *   1   1
+      1   1   1
+          1
+    """
+    pix = img[y, x]
+    # all integer and branchless: 255 if pix > 128 else 0; the error is truncated to 1/8 with a shift
+    col = (pix > 128) * 255
+    out[y, x] = col
+    err = (pix - col) >> 3
+    if x + 1 < width:
+        img[y, x + 1] += err
+    if x + 2 < width:
+        img[y, x + 2] += err
+    if y + 1 < height:
+        if x > 0:
+            img[y + 1, x - 1] += err
+        img[y + 1, x] += err
+        if x + 1 < width:
+            img[y + 1, x + 1] += err
+    if y + 2 < height:
+        img[y + 2, x] += err
+
+
+@njit(cache=True, boundscheck=False, parallel=True)
+def atkinson(img: np.ndarray, out: np.ndarray, height: int, width: int):
+    """
+    Same result as dithering pixel by pixel, but split into tiles that can run in parallel.
+    Every pixel that (y, x) takes error from has a smaller u = x + 2 * y, so in (y, u) coordinates
+    the image is cut into TILE_ROWS x TILE_COLS tiles and tile (b, k) runs at step k + 2 * b:
+    everything it depends on ran at an earlier step, and no two tiles in the same step
+    diffuse error into the same pixels.
+    :param img: int16 greyscale pixels, 0-255; modified in place as error is diffused into it
+    :param out: uint8 output, 0 or 255 per pixel
+    """
+    row_tiles = (height + TILE_ROWS - 1) // TILE_ROWS
+    col_tiles = (width + 2 * (height - 1) + TILE_COLS - 1) // TILE_COLS
+    for step in range(col_tiles + 2 * (row_tiles - 1)):
+        for b in prange(row_tiles):
+            k = step - 2 * b
+            if k < 0 or k >= col_tiles:
+                continue
+            for y in range(b * TILE_ROWS, min((b + 1) * TILE_ROWS, height)):
+                x_start = max(k * TILE_COLS - 2 * y, 0)
+                x_end = min((k + 1) * TILE_COLS - 2 * y, width)
+                for x in range(x_start, x_end):
+                    _diffuse(img, out, y, x, height, width)
@@ -0,0 +1,20 @@
+"""
+Compile the numba kernels in _kernels.py ahead of time into the macpaint_kernels extension module,
+so the converter doesn't pay for importing numba and JIT compiling on every run.
+Run once from this directory: python build_kernels.py
+"""
+import os
+from numba.pycc import CC
+import _kernels
+
+cc = CC("macpaint_kernels")
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+# AOT compilation is serial only, so atkinson and pack_bits_rows_parallel lose their prange parallelism here
+cc.export("pack_bits_row", "i8(u1[:], u1[:])")(_kernels.pack_bits_row.py_func)
+cc.export("pack_bits_rows", "i8(u1[:, :], u1[:])")(_kernels.pack_bits_rows.py_func)
+cc.export("pack_bits_rows_parallel", "i8(u1[:, :], u1[:])")(_kernels.pack_bits_rows_parallel.py_func)
+cc.export("unpack_bits", "i8(u1[:], u1[:])")(_kernels.unpack_bits.py_func)
+cc.export("atkinson", "void(i2[:, :], u1[:, :], i8, i8)")(_kernels.atkinson.py_func)
+
+if __name__ == "__main__":
+    cc.compile()
@@ -1,24 +1,55 @@
 import argparse
+import glob
+import os
+from multiprocessing import Pool
+import numpy as np
 from macpaint import MacPaintFile
-from formats import PNGFile
+from formats import PNGFile, dither
 
-def main(args):
-    if args.from_macpaint:
-        macpaint_file = MacPaintFile.from_file(args.infile)
-        PNGFile.write_image(args.outfile, macpaint_file)
-    elif args.to_macpaint:
-        png = PNGFile(args.infile)
-        macpaint_file = png.convert()
-        macpaint_file.write_file(args.outfile)
+def convert(infile: str, outfile: str, from_macpaint: bool):
+    if from_macpaint:
+        macpaint_file = MacPaintFile.from_file(infile)
+        PNGFile.write_image(outfile, macpaint_file)
     else:
+        macpaint_file = MacPaintFile.from_png(infile)
+        macpaint_file.write_file(outfile)
+
+def _warm():
+    # get the kernels compiled (or loaded from numba's cache) once per worker, not once per file
+    MacPaintFile.from_scanlines(np.full((MacPaintFile.HEIGHT, MacPaintFile.WIDTH), MacPaintFile.WHITE))
+    dither(np.zeros((1, 1), dtype=np.uint8))
+
+def main(args):
+    if not (args.from_macpaint or args.to_macpaint):
         raise RuntimeError("must specify either --from-macpaint or --to-macpaint")
+    if not args.glob:
+        convert(args.infile, args.outfile, args.from_macpaint)
+        return
+    extension = ".png" if args.from_macpaint else ".mac"
+    infiles = glob.glob(args.infile)
+    if not infiles:
+        raise RuntimeError(f"no files match {args.infile}")
+    # output path -> input path; workers write at the same time, so two inputs can't share an output
+    outfiles = dict()
+    for infile in infiles:
+        name = os.path.splitext(os.path.basename(infile))[0]
+        outfile = os.path.join(args.outfile, name + extension)
+        if outfile in outfiles:
+            raise RuntimeError(f"{outfiles[outfile]} and {infile} would both be converted to {outfile}")
+        outfiles[outfile] = infile
+    jobs = [(infile, outfile, args.from_macpaint) for outfile, infile in outfiles.items()]
+    os.makedirs(args.outfile, exist_ok=True)
+    # every file is independent, so just spread them over all the cores
+    with Pool(initializer=_warm) as pool:
+        pool.starmap(convert, jobs)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--from-macpaint", "-m", action="store_true", help="Convert from MacPaint to PNG")
     parser.add_argument("--to-macpaint", "-p", action="store_true", help="Convert from PNG to MacPaint")
+    parser.add_argument("--glob", "-g", action="store_true", help="infile is a glob pattern and outfile a directory; convert every matching file in parallel")
     parser.add_argument("--informat")
     parser.add_argument("infile", help="Input file path")
     parser.add_argument("outfile", help="Output file path")
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
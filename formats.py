@@ -1,36 +1,41 @@
 from abc import ABC, abstractmethod
-from typing import Sequence, List
+from typing import List
 import png
 import os
 import struct
+import numpy as np
 from macpaint import MacPaintFile
+try:
+    from macpaint_kernels import atkinson # see build_kernels.py
+except ImportError:
+    from _kernels import atkinson
 
 GAMMA = 2.2
-
-def chunks(lst: Sequence, n: int):
-    """Yield successive n-sized chunks from lst."""
-    # https://stackoverflow.com/questions/312443/how-do-you-split-a-list-into-evenly-sized-chunks
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-def dither(grey_rows: List[bytes]) -> List[bytes]:
+# Y is kept as a 16-bit fixed point fraction so the whole conversion is table lookups
+_Y_ONE = 1 << 16
+# 8-bit channel value -> that channel's contribution to linear luminance Y
+_R_TO_Y, _G_TO_Y, _B_TO_Y = (
+    np.rint(weight * pow(np.arange(256) / 255, GAMMA) * _Y_ONE).astype(np.int32)
+    for weight in (0.2126, 0.7152, 0.0722)
+)
+# fixed point Y -> 8-bit grey, via L*; the +2 covers rounding in the three channel tables
+_L = (116 * np.cbrt(np.minimum(np.arange(_Y_ONE + 2) / _Y_ONE, 1)) - 16) / 100
+_Y_TO_GREY = np.rint(np.maximum(_L, 0) * 255).astype(np.uint8)
+
+def dither(grey_rows: List[bytes]) -> np.ndarray:
     """
-    TODO Atkinson dithering for greyscale image; for now only rounding grey to black/white
+    Atkinson dithering for greyscale image
     :param grey_rows: 0-255 values, one byte per pixel
     :return: 0 or 255 values only, one byte per pixel
     """
-    dithered = list()
-    for row in grey_rows:
-        dithered_row = bytearray()
-        for b in row:
-            if b > 0x80:
-                dithered_row.append(MacPaintFile.WHITE)
-            else:
-                dithered_row.append(MacPaintFile.BLACK)
-        dithered.append(dithered_row)
+    # copy, since the error is diffused into the image as we go
+    img = np.array(grey_rows, dtype=np.int16)
+    height, width = img.shape
+    dithered = np.empty((height, width), dtype=np.uint8)
+    atkinson(img, dithered, height, width)
     return dithered
 
-def to_greyscale(color_rows: List[List[int]], alpha: bool) -> List[bytes]:
+def to_greyscale(color_rows: List[List[int]], alpha: bool) -> np.ndarray:
     """
 
     :param color_rows: 3 or 4 bytes per pixel, 8-bit RGB/A
@@ -42,29 +47,14 @@ def to_greyscale(color_rows: List[List[int]], alpha: bool) -> List[bytes]:
         print("discarding alpha channel, sorry! re-encode without alpha for better result")
     else:
         bytes_per_pixel = 3
-    greyscale_rows = list()
     for i, row in enumerate(color_rows):
-        grey_row = bytearray()
         if len(row) % bytes_per_pixel != 0:
             raise RuntimeError(f"row {i} does not contain a multiple of {bytes_per_pixel} values; must be 8-bit RGB{'A' if alpha else ''}")
-        for pixel in chunks(row, bytes_per_pixel):
-            if alpha:
-                [r, g, b, a] = pixel
-            else:
-                [r, g, b] = pixel
-            # https://stackoverflow.com/questions/687261/converting-rgb-to-grayscale-intensity
-            r_lin = pow(r / 255, GAMMA)
-            g_lin = pow(g / 255, GAMMA)
-            b_lin = pow(b / 255, GAMMA)
-            Y = 0.2126 * r_lin + 0.7152 * g_lin + 0.0722 * b_lin
-            L = (116 * pow(Y, 1/3) - 16) / 100
-            if L < -5:
-                raise RuntimeError(f"unexpectedly negative Luminance: {L}")
-            L = max(L, 0)
-            byte = round(L * 255)
-            grey_row.append(byte)
-        greyscale_rows.append(grey_row)
-    return greyscale_rows
+    pixels = np.asarray(color_rows, dtype=np.uint8)
+    pixels = pixels.reshape(len(pixels), -1, bytes_per_pixel)
+    # https://stackoverflow.com/questions/687261/converting-rgb-to-grayscale-intensity
+    Y = _R_TO_Y[pixels[:, :, 0]] + _G_TO_Y[pixels[:, :, 1]] + _B_TO_Y[pixels[:, :, 2]]
+    return _Y_TO_GREY[Y]
 
 
 class ImageConverter(ABC):
@@ -90,10 +80,10 @@ class PNGFile(ImageConverter):
     ALPHA = 4
     def __init__(self, path: str):
         reader = png.Reader(filename=path)
-        self.width, self.height, self.rows, self.info = reader.read()
-        self.rows = [[b for b in row] for row in self.rows]
+        self.width, self.height, pixels, self.info = reader.read_flat()
+        self.rows = np.frombuffer(pixels, dtype=np.uint8).reshape(self.height, -1)
         if reader.bitdepth == 1:
-            self.rows = [[255 if b else 0 for b in row] for row in self.rows]
+            self.rows = np.where(self.rows, MacPaintFile.WHITE, MacPaintFile.BLACK).astype(np.uint8)
         elif reader.bitdepth != 8:
             raise NotImplementedError("this PNG does not use 8-bit color/grey; only 1-bit or 8-bit supported")
         # https://gitlab.com/drj11/pypng/-/blob/612d2bde70805fc85979f176410fc7fb9f3c0754/code/png.py#L1665
@@ -109,42 +99,25 @@ class PNGFile(ImageConverter):
             self.rows = to_greyscale(self.rows, alpha)
         if self._need_dither():
             self.rows = dither(self.rows)
-
-        #if not isinstance(self.rows, list):
-        #    self.rows = list(self.rows)
-        self.rows: List[List[int]]
+        self.rows: np.ndarray
 
     def _need_dither(self):
-        need_dither = False
-        for row in self.rows:
-            for b in row:
-                if b not in (MacPaintFile.WHITE, MacPaintFile.BLACK):
-                    need_dither = True
-                    break
-        return need_dither
+        return bool(((self.rows != MacPaintFile.WHITE) & (self.rows != MacPaintFile.BLACK)).any())
 
     def convert(self) -> MacPaintFile:
-        rows = self.rows
-        if self.height > MacPaintFile.HEIGHT:
-            rows = rows[:MacPaintFile.HEIGHT]
-        if self.height < MacPaintFile.HEIGHT:
-            add_rows = MacPaintFile.HEIGHT - height
-            for _ in range(add_rows):
-                rows.append([MacPaintFile.WHITE] * MacPaintFile.WIDTH)
-        if self.width > MacPaintFile.WIDTH:
-            rows = [row[:MacPaintFile.WIDTH] for row in rows]
-        if self.width < MacPaintFile.WIDTH:
-            new_rows = list()
-            add_pixels = MacPaintFile.WIDTH - self.width
-            for row in rows:
-                new_rows.append(row + [MacPaintFile.WHITE] * add_pixels)
-            rows = new_rows
+        rows = self.rows[:MacPaintFile.HEIGHT, :MacPaintFile.WIDTH]
+        add_rows = MacPaintFile.HEIGHT - rows.shape[0]
+        add_pixels = MacPaintFile.WIDTH - rows.shape[1]
+        if add_rows or add_pixels:
+            rows = np.pad(rows, ((0, add_rows), (0, add_pixels)), constant_values=MacPaintFile.WHITE)
         return MacPaintFile.from_scanlines(rows)
 
     @classmethod
     def write_image(cls, path: str, macpaint_file: MacPaintFile):
         with open(path, 'wb') as f:
-            w = png.Writer(macpaint_file.WIDTH, macpaint_file.HEIGHT, greyscale=True)
-            w.write(f, macpaint_file.bitmap)
+            # the scanlines are already 1 bit per pixel, only with 1 == black, so they go straight out as a 1-bit PNG
+            # rather than being expanded to a byte per pixel first
+            w = png.Writer(macpaint_file.WIDTH, macpaint_file.HEIGHT, greyscale=True, bitdepth=1)
+            w.write_packed(f, ~macpaint_file.scanlines)
 
 
@@ -1,20 +1,78 @@
+import re
 import struct
-from collections.abc import Sequence
 from typing import List
+import os
 import sys
 import png
-import subprocess
+import ctypes
+import numpy as np
+import numpy.typing as npt
+try:
+    from macpaint_kernels import pack_bits_row, pack_bits_rows, pack_bits_rows_parallel, unpack_bits # see build_kernels.py
+    COMPILED = True
+except ImportError:
+    from _kernels import pack_bits_row, pack_bits_rows, pack_bits_rows_parallel, unpack_bits, COMPILED
 
 # https://web.archive.org/web/20080705155158/http://developer.apple.com/technotes/tn/tn1023.html
 # https://web.archive.org/web/20150424145627/http://www.idea2ic.com/File_Formats/macpaint.pdf
 # http://www.weihenstephan.org/~michaste/pagetable/mac/Inside_Macintosh.pdf
 # https://en.wikipedia.org/wiki/PackBits
 
-def chunks(lst: Sequence, n: int):
-    """Yield successive n-sized chunks from lst."""
-    # https://stackoverflow.com/questions/312443/how-do-you-split-a-list-into-evenly-sized-chunks
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+# packing 720 72-byte lines is usually done before threads would pay for themselves, so this is opt-in
+PARALLEL_PACK = os.environ.get("MACPAINT_PARALLEL_PACK") not in (None, "", "0")
+
+# PackBits header byte -> (kind, count of bytes it decompresses to)
+_SKIP, _RUN, _LITERAL = range(3)
+_HEADERS = tuple(
+    (_LITERAL, header + 1) if header < 128 else (_SKIP, 0) if header == 128 else (_RUN, 256 - header + 1)
+    for header in range(256)
+)
+# byte value -> the longest run of it a header can ask for; runs are sliced from these instead of built each time
+_FILL = tuple(bytes((byte,)) * 128 for byte in range(256))
+# a maximal run of 3+ equal bytes, which is what PackBits compresses
+_RUNS = re.compile(rb"(.)\1{2,}", re.DOTALL)
+
+def _unpack_bits(scanline_data: bytes, size: int = None) -> np.ndarray:
+    """
+    Runs and literal strings are copied into the output with C-level bytearray extends,
+    so Python only loops over headers, not bytes; or with the compiled kernel, not even those
+
+    :param size: how many bytes the data is expected to decode to, a whole MacPaint image if not given;
+        the compiled kernel decodes a second time only if the data turns out longer than this
+    :return: the decoded bytes as a flat uint8 array, longer than size if there's junk at the end
+    """
+    if size is None:
+        size = MacPaintFile.HEIGHT * (MacPaintFile.WIDTH // 8)
+    if COMPILED:
+        src = np.frombuffer(scanline_data, dtype=np.uint8)
+        result = np.empty(size, dtype=np.uint8)
+        size = unpack_bits(src, result)
+        if size > len(result):
+            # junk at the end; decode again so the caller can report how much
+            result = np.empty(size, dtype=np.uint8)
+            unpack_bits(src, result)
+        return result[:size]
+    # growing by extend is amortized; slice-assigning into a preallocated buffer measured about 2x slower
+    result = bytearray()
+    i = 0
+    while i < len(scanline_data):
+        kind, count = _HEADERS[scanline_data[i]]
+        if kind == _SKIP:
+            # ignored, next byte is another header
+            i += 1
+        elif kind == _RUN:
+            # twos complement -1 to -127
+            # next byte repeated n times
+            if i + 1 >= len(scanline_data):
+                # truncated: a run header with no byte to repeat; stop like the compiled kernel does
+                break
+            result += _FILL[scanline_data[i + 1]][:count]
+            i += 2
+        else:
+            # n bytes of literal uncompressed data
+            result += scanline_data[i + 1 : i + 1 + count]
+            i += 1 + count
+    return np.frombuffer(result, dtype=np.uint8)
 
 def _pack_bits(line: bytes) -> bytes:
     """
@@ -25,180 +83,213 @@ def _pack_bits(line: bytes) -> bytes:
     """
     if len(line) > 127:
         raise RuntimeError(f"scanline is too long: {len(line)}; can only compress 127 bytes at a time, MacPaint lines should be 72 bytes")
+    if not COMPILED:
+        return _BLANK_LINES.get(bytes(line)) or _pack_runs(line) # bytes(line) so a bytearray can be looked up too
+    src = np.frombuffer(line, dtype=np.uint8)
+    packed = np.empty(2 * len(src) + 1, dtype=np.uint8)
+    used = pack_bits_row(src, packed)
+    return packed[:used].tobytes()
+
+def _pack_runs(line: bytes) -> bytes:
+    """
+    Same encoding as pack_bits_row, for when it can't be compiled: the regex engine finds the runs of
+    3+ equal bytes in C, so Python only loops over those runs rather than over bytes
+    """
     packed = bytearray()
-    i = 0
-    while i < len(line):
-        # precondition: i < len(line) - 2
-        if line[i : i + 3] == bytearray([line[i]] * 3):
-            j = i
-            # 3+ bytes the same, compress these
-            while j < len(line) and line[j] == line[i] and j - i < 127:
-                j += 1
-            count = j - i
-            # the sign bit of the header is used to indicate whether the byte is repeated or a literal string
-            # when repeated, the count is the two's complement negative value of the header
-            # this must have been an efficient use of 68000 instructions or something
-            header = 256 - count + 1
-            byte = line[i]
-            packed += struct.pack(">B", header)
-            packed.append(byte)
-        else:
-            # literal bytes
-            # postcondition: j <= len(line) - 3 or  j == len(line}
-            j = i + 1
-            while j < len(line):
-                end = min(j + 3, len(line))
-                if line[j : end] == bytearray([line[j]] * 3):
-                    break
-                j += 1
-            count = j - i
-            header = count - 1  # literal bytes header is 1+n: https://en.wikipedia.org/wiki/PackBits
-            literal_bytes = line[i : j]
-            packed += struct.pack(">B", header) + literal_bytes
-        i = j
-    return packed
+    literal_start = 0
+    for run in _RUNS.finditer(line):
+        start, end = run.span()
+        _pack_literal(packed, line, literal_start, start)
+        while end - start >= 3:
+            count = min(end - start, 127)
+            packed.append(256 - count + 1)
+            packed.append(line[start])
+            start += count
+        # 1 or 2 bytes left over from splitting a long run start the next literal string
+        literal_start = start
+    _pack_literal(packed, line, literal_start, len(line))
+    return bytes(packed)
+
+def _pack_literal(packed: bytearray, line: bytes, start: int, end: int):
+    for i in range(start, end, 128):
+        literal_bytes = line[i : min(i + 128, end)]
+        packed.append(len(literal_bytes) - 1) # literal bytes header is 1+n: https://en.wikipedia.org/wiki/PackBits
+        packed += literal_bytes
+
+# all-white and all-black 72-byte scanlines, by far the commonest, with their encodings worked out up front
+_BLANK_LINES = {line: _pack_runs(line) for line in (bytes(72), b'\xff' * 72)}
+
+# type code PNTG, creator code MPNT
+PNTGMPNT = bytes.fromhex("50 4E 54 47 4D 50 4E 54 01 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00")
+
+def _set_finder_info(path: str):
+    """
+    Same as `xattr -wx com.apple.FinderInfo ...`, but one syscall instead of a whole process.
+    os.setxattr only exists on Linux, so call macOS's setxattr(2) through ctypes.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.setxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_uint32, ctypes.c_int]
+    if libc.setxattr(os.fsencode(path), b"com.apple.FinderInfo", PNTGMPNT, len(PNTGMPNT), 0, 0) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), path)
 
 
 class Header:
     SIZE = 512
+    _VERSION = struct.Struct("=I")
+    PATTERN_SIZE = 8
 
-    def __init__(self, version: int, patterns: List[bytes], reserved: bytes, raw: bytes):
+    def __init__(self, version: int, patterns: List[bytes], reserved: bytes, raw: bytes, pattern_block: bytes = None):
+        """
+        :param pattern_block: the 304-byte patterns region as it is in the file, instead of patterns
+        """
         self.version = version
-        self.patterns = patterns
+        self._pattern_block = pattern_block
+        self._patterns = patterns
         self.reserved = reserved
         self.raw_str = raw
 
+    @property
+    def patterns(self) -> List[bytes]:
+        # only split the block into 38 patterns if someone asks; the list is kept so changes to it get packed
+        if self._patterns is None:
+            block = self._pattern_block
+            self._patterns = [block[i:i + self.PATTERN_SIZE] for i in range(0, len(block), self.PATTERN_SIZE)]
+        return self._patterns
+
+    @patterns.setter
+    def patterns(self, patterns: List[bytes]):
+        self._patterns = patterns
+
     @classmethod
     def from_file(cls, path: str):
         with open(path, 'rb') as f:
-            d = f.read()
+            d = f.read(cls.SIZE)
             return cls.parse(d)
 
     @classmethod
     def parse(cls, raw: bytes):
-        version = struct.unpack("=I", raw[:4])[0]
-        _patterns = struct.unpack("=" + 38*"8s", raw[4:308])
-        patterns = list(_patterns)
+        """
+        :param raw: the file contents, or just the first SIZE bytes of it
+        """
+        raw = bytes(raw[:cls.SIZE])
+        version = cls._VERSION.unpack_from(raw)[0]
+        pattern_block = raw[4:308]
         reserved = raw[308:]
-        return cls(version, patterns, reserved, raw)
+        return cls(version, None, reserved, raw, pattern_block)
 
     @classmethod
     def gen_default(cls):
         version = 0
-        patterns = [b'\0' for _ in range(304)]
+        pattern_block = bytes(304)
         future = b'\0' * 204
         data = bytes()
-        return cls(version, patterns, future, data)
+        return cls(version, None, future, data, pattern_block)
 
     def pack(self) -> bytes:
         version = struct.pack(">I", self.version)
-        return version + b''.join(self.patterns) + self.reserved
+        patterns = self._pattern_block if self._patterns is None else b''.join(self._patterns)
+        return version + patterns + self.reserved
 
 class MacPaintFile:
     WIDTH = 576
     HEIGHT = 720
     WHITE = 255
     BLACK = 0
+    # scanline byte -> its 8 pixels, higher order bits first left->right
+    # PNG: 0 == black; MacPaint: 0 == bit/pixel not set ie white
+    _UNPACK_LUT = np.where(np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1), BLACK, WHITE).astype(np.uint8)
 
-    def __init__(self, header: Header, data: bytes, bitmap: List[List[int]] = None):
+    def __init__(self, header: Header, data: bytes, bitmap: npt.ArrayLike = None, scanlines: np.ndarray = None):
         self.header = header
         self.data = data
-        decompressed_data = self._unpack_bits(self.data)
-        self.scanlines = list(chunks(decompressed_data, self.WIDTH // 8))
-        #self._generate_bitmap()
-        if len(self.scanlines) > self.HEIGHT:
-            print("found {} junk(?) scanlines at end of file, discarding".format(len(self.scanlines) - self.HEIGHT))
-            self.scanlines = self.scanlines[:self.HEIGHT]
-        assert len(self.scanlines) == self.HEIGHT, "error: got {} scanlines, expected {}".format(len(self.scanlines), self.HEIGHT)
-        self._bitmap: List[List[int]] = bitmap
+        if scanlines is None:
+            # decode only when the caller doesn't already have the bit lines, e.g. from_scanlines
+            scanlines = self._decode_scanlines(self.data)
+        # one contiguous (HEIGHT, WIDTH // 8) buffer; each row is a view into it, not a copy
+        self.scanlines: np.ndarray = scanlines
+        # HEIGHT x WIDTH uint8 array, generated from the scanlines on first use if not given
+        self._bitmap: np.ndarray = None if bitmap is None else np.asarray(bitmap, dtype=np.uint8)
+
+    def _decode_scanlines(self, data: bytes) -> np.ndarray:
+        decompressed_data = _unpack_bits(data, self.HEIGHT * (self.WIDTH // 8))
+        row_bytes = self.WIDTH // 8
+        scanline_count = -(-len(decompressed_data) // row_bytes)
+        if scanline_count > self.HEIGHT:
+            print("found {} junk(?) scanlines at end of file, discarding".format(scanline_count - self.HEIGHT))
+            decompressed_data = decompressed_data[:self.HEIGHT * row_bytes]
+        assert len(decompressed_data) == self.HEIGHT * row_bytes, "error: got {} bytes of scanline data, expected {}".format(len(decompressed_data), self.HEIGHT * row_bytes)
+        return decompressed_data.reshape(self.HEIGHT, row_bytes)
 
     @classmethod
     def from_file(cls, path: str):
-        header = Header.from_file(path)
         with open(path, 'rb') as f:
             filedata = f.read()
+        header = Header.parse(filedata)
         data = filedata[Header.SIZE:]
         return cls(header, data)
 
     @classmethod
-    def from_scanlines(cls, bitmap: List[List[int]]) -> "MacPaintFile":
+    def from_png(cls, path: str) -> "MacPaintFile":
+        from formats import PNGFile # formats imports this module
+        return PNGFile(path).convert()
+
+    @classmethod
+    def from_scanlines(cls, bitmap: npt.ArrayLike) -> "MacPaintFile":
+        """
+        :param bitmap: HEIGHT x WIDTH pixels, each BLACK or WHITE; a uint8 ndarray is used as is, without a copy
+        """
         header = Header.gen_default()
-        packed_bits = cls._gen_packed_data(bitmap)
-        return cls(header, packed_bits, bitmap)
+        pixels = cls._gen_pixels(bitmap)
+        scanlines = cls._gen_scanlines(pixels)
+        packed_bits = cls._gen_packed_data(scanlines)
+        return cls(header, packed_bits, pixels, scanlines)
 
     def write_file(self, path: str):
         with open(path, 'wb') as f:
             f.write(self.header.pack() + self.data)
 
         if sys.platform == "darwin":
-            PNTGMPNT = "50 4E 54 47 4D 50 4E 54 01 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00"
-            command = ["xattr", "-wx", "com.apple.FinderInfo", PNTGMPNT, path]
             try:
-                subprocess.check_call(command)
-            except:
+                _set_finder_info(path)
+            except OSError:
                 print(f"warning: could not set creator code/type code with xattr; MacPaint will not be able to open {path} unless you change the creator/type codes with ResEdit or xattr")
 
-    def _unpack_bits(self, scanline_data: bytes) -> bytearray:
-        result = []
-        i = 0
-        while i < len(scanline_data):
-            header = scanline_data[i]
-            if header == 128:
-                # ignored, next byte is another header
-                i += 1
-            elif header > 128:
-                # twos complement -1 to -127
-                # next byte repeated n times
-                count = 256 - header + 1
-                _byte = scanline_data[i + 1]
-                decompressed = count * [_byte]
-                result += decompressed
-                i += 2
-            else:
-                # n bytes of literal uncompressed data
-                count = header + 1
-                _bytes = scanline_data[i+1 : i + 1 + count]
-                result += list(_bytes)
-                i += 1 + count
-        return bytearray(result)
-
     @classmethod
-    def _gen_packed_data(cls, bitmap: List[List[int]]) -> bytes:
+    def _gen_pixels(cls, bitmap: npt.ArrayLike) -> np.ndarray:
+        """
+        Checks the bitmap and converts it to the HEIGHT x WIDTH uint8 array kept as the bitmap,
+        so a list of lists only gets walked once
+        """
         assert len(bitmap) == cls.HEIGHT, f"trying to pack {len(bitmap)} scanlines, expected {cls.HEIGHT}"
-        bits = bytearray()
-        for _, raw_line in enumerate(bitmap):
-            i = 0
-            bit_line = bytearray()
-            while i < len(raw_line):
-                byte = 0
-                for j in range(8):
-                    value = raw_line[i + j]
-                    assert value in (cls.BLACK, cls.WHITE), f"got bad value for a pixel color: {value}"
-                    if value == cls.BLACK:
-                        byte |= 0x1 << (7 - j) # higher order bits come first left->right
-                i += 8
-                bit_line.append(byte)
-            assert len(bit_line) == cls.WIDTH / 8, f"error in condensing bytes into bits; line is only {len(bit_line)} bytes"
-            packed_line = _pack_bits(bit_line)
-            bits += packed_line
-        return bits
-
-    def _generate_bitmap(self):
-        bitmap = []
-        for i in range(len(self.scanlines)):
-            scanline = self.scanlines[i]
-            bitmap_line = []
-            for j in range(self.WIDTH // 8):
-                byte = scanline[j]
-                for k in range(8):
-                    mask = 0x1 << (7 - k) # higher order bits come first left->right
-                    # PNG: 0 == black; MacPaint: 0 == bit/pixel not set ie white
-                    bitmap_line.append(self.BLACK if (byte & mask) > 0 else self.WHITE)
-            bitmap.append(bitmap_line)
-        return bitmap
+        pixels = np.asarray(bitmap)
+        assert pixels.shape[1] == cls.WIDTH, f"trying to pack {pixels.shape[1]} pixel wide scanlines, expected {cls.WIDTH}"
+        bad = (pixels != cls.BLACK) & (pixels != cls.WHITE)
+        assert not bad.any(), f"got bad value for a pixel color: {pixels[bad][0]}"
+        # checked before casting so out of range values can't wrap around to BLACK or WHITE
+        return pixels.astype(np.uint8, copy=False)
+
+    @classmethod
+    def _gen_scanlines(cls, pixels: np.ndarray) -> np.ndarray:
+        return np.packbits(pixels == cls.BLACK, axis=1) # higher order bits come first left->right
+
+    @classmethod
+    def _gen_packed_data(cls, bit_lines: np.ndarray) -> bytes:
+        if not COMPILED:
+            return b''.join(_pack_bits(bit_line.tobytes()) for bit_line in bit_lines)
+        # one output buffer for the whole image, big enough for the worst case of every line
+        packed = np.empty(cls.HEIGHT * (2 * bit_lines.shape[1] + 1), dtype=np.uint8)
+        used = (pack_bits_rows_parallel if PARALLEL_PACK else pack_bits_rows)(bit_lines, packed)
+        return packed[:used].tobytes()
+
+    def _generate_bitmap(self) -> np.ndarray:
+        return self._UNPACK_LUT[self.scanlines].reshape(self.HEIGHT, self.WIDTH)
 
     @property
-    def bitmap(self):
+    def bitmap(self) -> np.ndarray:
+        """
+        HEIGHT x WIDTH uint8 array of BLACK and WHITE pixels; no longer a list of lists
+        """
         if self._bitmap is None:
             self._bitmap = self._generate_bitmap()
         return self._bitmap